@@ -4,15 +4,44 @@ Single-model OpenRouter integration (Trinity Mini - FREE)
 FIXED: Strong mentor prompt
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+# Patch sockets before requests/urllib3 are imported so upstream waits yield
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
+import gzip
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from database import Database
+from database import Database, level_for
 
 # -------------------- App Setup --------------------
+class OrjsonProvider(JSONProvider):
+    """Use orjson for jsonify and request.json"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of via dumps()'s str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 app = Flask(__name__, static_folder="../frontend", static_url_path="")
+app.json = OrjsonProvider(app)
 CORS(app)
 
 db = Database()
@@ -23,6 +52,32 @@ OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
 
 MODEL_ID = "arcee-ai/trinity-mini:free"
 
+# -------------------- HTTP Session --------------------
+# One pooled session for all OpenRouter calls so TCP+TLS connections are
+# kept alive between chat turns instead of re-negotiated every request.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    # Every OpenRouter call is a POST, which urllib3 won't retry unless told to.
+    # raise_on_status=False hands the last response back so callers can report it.
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset({"POST"}),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+SESSION.headers.update({
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "Accept-Encoding": "gzip",
+    "HTTP-Referer": "https://english-mentor.onrender.com",
+    "X-Title": "Telugu English Mentor"
+})
+
 # -------------------- SYSTEM PROMPT (FIXED) --------------------
 SYSTEM_PROMPT = """
 You are TEM, a Telugu English Mentor.
@@ -46,31 +101,62 @@ Good try 🙂
 Correct sentence: I went to the market yesterday.
 """
 
+# Built once so each request only prepends a reference to it
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
 # -------------------- OpenRouter Call --------------------
+# Request bodies above this size are gzipped before upload
+COMPRESS_MIN_BYTES = 1024
+# Fast level: most of the win on JSON text for a fraction of level 9's CPU
+COMPRESS_LEVEL = 5
+
+# Cleared for the rest of the process the first time upstream rejects a gzipped body
+_gzip_uploads = True
+
+def _rejects_gzip(res):
+    """Whether a response says upstream can't take a gzip-encoded request body"""
+    if res.status_code == 415:
+        return True
+    if res.status_code == 400:
+        text = res.text.lower()
+        return any(word in text for word in ("encoding", "gzip", "decompress"))
+    return False
+
+def post_openrouter(payload, **kwargs):
+    """
+    POST a payload to OpenRouter, gzipping large bodies
+    If upstream rejects the compression, stop compressing and resend uncompressed
+    """
+    global _gzip_uploads
+    body = orjson.dumps(payload)
+
+    if _gzip_uploads and len(body) > COMPRESS_MIN_BYTES:
+        res = SESSION.post(
+            OPENROUTER_API_URL,
+            data=gzip.compress(body, compresslevel=COMPRESS_LEVEL),
+            headers={"Content-Encoding": "gzip"},
+            timeout=30,
+            **kwargs
+        )
+        if not _rejects_gzip(res):
+            return res
+        res.close()
+        _gzip_uploads = False
+
+    return SESSION.post(OPENROUTER_API_URL, data=body, timeout=30, **kwargs)
+
 def call_openrouter(messages):
     if not OPENROUTER_API_KEY:
         return {"error": True, "message": "OPENROUTER_API_KEY not set"}
 
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://english-mentor.onrender.com",
-        "X-Title": "Telugu English Mentor"
-    }
-
     payload = {
         "model": MODEL_ID,
-        "messages": [{"role": "system", "content": SYSTEM_PROMPT}] + messages,
+        "messages": [SYSTEM_MSG, *messages],
         "temperature": 0.6
     }
 
     try:
-        res = requests.post(
-            OPENROUTER_API_URL,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        res = post_openrouter(payload)
 
         if res.status_code != 200:
             return {
@@ -78,7 +164,7 @@ def call_openrouter(messages):
                 "message": f"OpenRouter error {res.status_code}: {res.text}"
             }
 
-        data = res.json()
+        data = orjson.loads(res.content)
         return {
             "error": False,
             "response": data["choices"][0]["message"]["content"]
@@ -87,6 +173,198 @@ def call_openrouter(messages):
     except Exception as e:
         return {"error": True, "message": str(e)}
 
+def stream_openrouter(messages):
+    """
+    Yield reply text chunks from a streaming OpenRouter completion
+    Raises RuntimeError if the upstream call fails
+    """
+    if not OPENROUTER_API_KEY:
+        raise RuntimeError("OPENROUTER_API_KEY not set")
+
+    payload = {
+        "model": MODEL_ID,
+        "messages": [SYSTEM_MSG, *messages],
+        "temperature": 0.6,
+        "stream": True
+    }
+
+    with post_openrouter(payload, stream=True) as res:
+        if res.status_code != 200:
+            raise RuntimeError(f"OpenRouter error {res.status_code}: {res.text}")
+
+        for line in res.iter_lines():
+            # Skip blank keep-alives and ": OPENROUTER PROCESSING" comments
+            if not line.startswith(b"data: "):
+                continue
+
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                break
+
+            delta = orjson.loads(data)["choices"][0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+# -------------------- Request Coalescing --------------------
+def solo_reply(user_message):
+    """Reply to one user's first message with a call carrying only that message"""
+    return call_openrouter([{"role": "user", "content": user_message}])
+
+class BatchScheduler:
+    """
+    Collect reply-cache misses arriving within a short window and send one
+    OpenRouter call per distinct message text, so concurrent new users sending
+    the same greeting ("hi") share a single upstream call before it is cached.
+    Messages from different users are never combined into one prompt: each
+    call carries exactly one message, so no user can see or steer another's reply.
+    """
+
+    def __init__(self, max_batch=8, max_wait_ms=50):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, user_message):
+        """Queue a message and block until its reply is ready"""
+        self._ensure_started()
+        future = Future()
+        self.queue.put((user_message, future))
+        return future.result()
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so each worker process starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue()
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for user_message, future in batch:
+                groups.setdefault(user_message, []).append(future)
+
+            # Distinct messages go upstream in parallel, one call each. The only
+            # retries are SESSION's own (up to 2 on 429/5xx); none are added here.
+            for user_message, futures in groups.items():
+                threading.Thread(target=self._dispatch, args=(user_message, futures), daemon=True).start()
+
+    @staticmethod
+    def _dispatch(user_message, futures):
+        try:
+            result = solo_reply(user_message)
+        except Exception as e:
+            result = {"error": True, "message": str(e)}
+
+        for future in futures:
+            future.set_result(result)
+
+batcher = BatchScheduler()
+
+# -------------------- Reply Cache --------------------
+# Short first-turn messages ("hi", "good morning") repeat a lot across users,
+# so their replies are kept in a per-process LRU and skip OpenRouter.
+REPLY_CACHE_MAX_LEN = 40
+
+@lru_cache(maxsize=512)
+def _cached_reply(user_message):
+    # Misses go through the scheduler so concurrent misses for the same text
+    # share one call. Every call it makes carries just this message, so a
+    # shared entry can't depend on any other user's input.
+    result = batcher.submit(user_message)
+    if result["error"]:
+        # Raise so failures are never stored in the cache
+        raise RuntimeError(result["message"])
+    return result["response"]
+
+def first_turn_reply(user_message):
+    """Reply to a user with no history: short messages via the cache, others directly"""
+    # Long first messages rarely repeat, so they skip the coalescing window
+    if len(user_message) >= REPLY_CACHE_MAX_LEN:
+        return solo_reply(user_message)
+
+    try:
+        return {"error": False, "response": _cached_reply(user_message)}
+    except RuntimeError as e:
+        return {"error": True, "message": str(e)}
+
+# -------------------- Helpers --------------------
+# Older turns are clipped so long replies don't inflate every later prompt
+HISTORY_USER_CHARS = 500
+HISTORY_AI_CHARS = 800
+
+def build_messages(history, user_message):
+    """Turn stored history plus the new message into chat messages"""
+    messages = [
+        m
+        for h in history
+        for m in (
+            {"role": "user", "content": h["user_message"][:HISTORY_USER_CHARS]},
+            {"role": "assistant", "content": h["ai_response"][:HISTORY_AI_CHARS]}
+        )
+    ]
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+# Chat bodies are a short message and a user id; reject anything larger unread.
+# MAX_CONTENT_LENGTH also caps chunked bodies that carry no Content-Length;
+# it allows one extra byte so a chunked read can tell "exactly at the limit"
+# from "over the limit".
+MAX_BODY_BYTES = 8192
+app.config["MAX_CONTENT_LENGTH"] = MAX_BODY_BYTES + 1
+
+def parse_chat_request():
+    """
+    Validate a chat request body
+    Returns (user_id, user_message, error response or None)
+    """
+    if (request.content_length or 0) > MAX_BODY_BYTES:
+        return None, None, (jsonify({"error": True, "message": "Payload too large"}), 413)
+
+    data = request.get_json(silent=True)
+
+    # Werkzeug stops reading a chunked body at MAX_CONTENT_LENGTH without
+    # raising, so a body longer than MAX_BODY_BYTES was over the limit
+    if request.content_length is None and len(request.get_data()) > MAX_BODY_BYTES:
+        return None, None, (jsonify({"error": True, "message": "Payload too large"}), 413)
+
+    if not isinstance(data, dict):
+        data = {}
+
+    user_message = data.get("message")
+    user_message = user_message.strip() if isinstance(user_message, str) else ""
+    user_id = data.get("user_id", "default_user")
+
+    if not user_message:
+        return None, None, (jsonify({"error": True, "message": "Message cannot be empty"}), 400)
+
+    if not isinstance(user_id, str) or not user_id:
+        return None, None, (jsonify({"error": True, "message": "Invalid user_id"}), 400)
+
+    return user_id, user_message, None
+
+def sse(event):
+    """Encode one server-sent event"""
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
 # -------------------- Routes --------------------
 @app.route("/")
 def index():
@@ -94,32 +372,26 @@ def index():
 
 @app.route("/api/chat", methods=["POST"])
 def chat():
-    data = request.json
-    user_message = data.get("message", "").strip()
-    user_id = data.get("user_id", "default_user")
-
-    if not user_message:
-        return jsonify({"error": True, "message": "Message cannot be empty"}), 400
+    user_id, user_message, error = parse_chat_request()
+    if error:
+        return error
 
     history = db.get_conversation_history(user_id, limit=6)
 
-    messages = []
-    for h in history:
-        messages.append({"role": "user", "content": h["user_message"]})
-        messages.append({"role": "assistant", "content": h["ai_response"]})
-
-    messages.append({"role": "user", "content": user_message})
+    messages = build_messages(history, user_message)
 
-    result = call_openrouter(messages)
+    # New users have no history to carry, so short first turns can be cached
+    if history:
+        result = call_openrouter(messages)
+    else:
+        result = first_turn_reply(user_message)
 
     if result["error"]:
         return jsonify(result), 500
 
     ai_response = result["response"]
-    db.save_conversation(user_id, user_message, ai_response)
-
-    count = db.get_conversation_count(user_id)
-    level = "Beginner" if count <= 20 else "Intermediate" if count <= 50 else "Advanced"
+    count = db.save_conversation(user_id, user_message, ai_response)
+    level = level_for(count)
 
     return jsonify({
         "error": False,
@@ -128,11 +400,63 @@ def chat():
         "conversation_count": count
     })
 
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    user_id, user_message, error = parse_chat_request()
+    if error:
+        return error
+
+    history = db.get_conversation_history(user_id, limit=6)
+    messages = build_messages(history, user_message)
+
+    def generate():
+        parts = []
+
+        # First turns go through first_turn_reply (reply cache) like /api/chat,
+        # and the finished reply is sent as a single delta
+        if not history:
+            result = first_turn_reply(user_message)
+            if result["error"]:
+                yield sse(result)
+                return
+            parts.append(result["response"])
+            yield sse({"delta": result["response"]})
+        else:
+            try:
+                for delta in stream_openrouter(messages):
+                    parts.append(delta)
+                    yield sse({"delta": delta})
+            except Exception as e:
+                yield sse({"error": True, "message": str(e)})
+                return
+
+        # Save the full reply only once the stream has finished. If the client
+        # disconnects first, GeneratorExit is raised at a yield above and the
+        # turn is intentionally not saved: the user never saw a full reply.
+        try:
+            count = db.save_conversation(user_id, user_message, "".join(parts))
+        except Exception as e:
+            yield sse({"error": True, "message": f"Could not save conversation: {e}"})
+            return
+
+        yield sse({
+            "done": True,
+            "level": level_for(count),
+            "conversation_count": count
+        })
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
+@app.errorhandler(413)
+def payload_too_large(e):
+    return jsonify({"error": True, "message": "Payload too large"}), 413
+
 @app.route("/health")
 def health():
     return jsonify({
         "status": "healthy",
-        "time": datetime.now().isoformat()
+        "time": datetime.now().isoformat(),
+        "reply_cache_hits": _cached_reply.cache_info().hits
     })
 
 # -------------------- Run --------------------
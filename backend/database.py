@@ -5,13 +5,101 @@ Manages conversation history and user data using SQLite
 
 import sqlite3
 import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from datetime import datetime
 import os
 
+def level_for(count):
+    """Map a conversation count to the learner's level"""
+    return "Advanced" if count > 50 else "Intermediate" if count > 20 else "Beginner"
+
+class WriteQueue:
+    """
+    Coalesce conversation writes from concurrent requests so that a single
+    background writer commits up to MAX_BATCH of them in one transaction.
+    """
+    MAX_BATCH = 100
+    MAX_PENDING = 1000
+    
+    def __init__(self, db):
+        self.db = db
+        self.queue = queue.Queue(maxsize=self.MAX_PENDING)  # Blocks callers when full
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    def submit(self, row):
+        """
+        Queue a row and block until the batch containing it is committed
+        Returns the user's conversation total after this row
+        """
+        self._ensure_started()
+        future = Future()
+        self.queue.put((row, future))
+        return future.result()
+    
+    def _ensure_started(self):
+        # Threads don't survive a fork, so each worker process starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(maxsize=self.MAX_PENDING)
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+    
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            try:
+                totals = self.db._write_batch([row for row, _ in batch])
+            except (sqlite3.IntegrityError, sqlite3.InterfaceError):
+                # A data error is down to one row: retry rows one at a time so a
+                # bad row only fails its own caller
+                for row, future in batch:
+                    try:
+                        total, = self.db._write_batch([row])
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(total)
+            except Exception as e:
+                # Anything else (e.g. "database is locked") would hit every row
+                # again, and SQLite's busy wait blocks the whole gevent worker
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), total in zip(batch, totals):
+                    future.set_result(total)
+
 class Database:
+    # In-process cache of per-user conversation counts for get_conversation_count.
+    # The TTL bounds how stale it can get when another worker process writes for
+    # the user, so the chat path reads counts from the database instead.
+    COUNT_CACHE_TTL = 60
+    COUNT_CACHE_SIZE = 10000
+    
     def __init__(self, db_path='data/conversations.db'):
         """Initialize database connection and create tables"""
         self.db_path = db_path
+        # One connection per process, shared by every request under a lock.
+        # threading.local would be per-greenlet under gevent, i.e. per request.
+        self._conn = None
+        self._conn_pid = None
+        self._conn_lock = threading.RLock()
+        self._count_cache = OrderedDict()  # user_id -> (count, expires_at)
+        self._count_lock = threading.Lock()
+        self._writes = WriteQueue(self)
         
         # Ensure data directory exists
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
@@ -19,111 +107,191 @@ class Database:
         self.init_database()
     
     def get_connection(self):
-        """Get database connection"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-        return conn
+        """
+        Get this process's database connection, opening it on first use
+        Callers must hold self._conn_lock while using it
+        """
+        # SQLite connections must not cross a fork (gunicorn --preload)
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+            # WAL makes a commit a log append, so NORMAL sync is still crash-safe
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA wal_autocheckpoint=1000')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA mmap_size=268435456')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
     
     def init_database(self):
         """Create database tables if they don't exist"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Conversations table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                user_message TEXT NOT NULL,
-                ai_response TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # User stats table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_stats (
-                user_id TEXT PRIMARY KEY,
-                total_conversations INTEGER DEFAULT 0,
-                level TEXT DEFAULT 'Beginner',
-                last_active DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create index for faster queries
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_user_id 
-            ON conversations(user_id)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_timestamp 
-            ON conversations(timestamp)
-        ''')
-        
-        conn.commit()
-        conn.close()
+        # Use a throwaway connection: with gunicorn --preload this runs in the
+        # master, which must not hold a SQLite handle when it forks workers
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            
+            # Write-ahead logging persists in the db file, so set it once here
+            cursor.execute('PRAGMA journal_mode=WAL')
+            
+            # Conversations table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    user_message TEXT NOT NULL,
+                    ai_response TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # User stats table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id TEXT PRIMARY KEY,
+                    total_conversations INTEGER DEFAULT 0,
+                    level TEXT DEFAULT 'Beginner',
+                    last_active DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Create index for faster queries
+            # History lookups filter on user_id and read the newest ids. SQLite
+            # appends the rowid (= id) to every index, so the old user_id-only
+            # index already served that without a sort; this one just names
+            # the ordering explicitly.
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_user_id_id
+                ON conversations(user_id, id DESC)
+            ''')
+            
+            # Same coverage as idx_user_id_id, so keep only one of them
+            cursor.execute('DROP INDEX IF EXISTS idx_user_id')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_timestamp 
+                ON conversations(timestamp)
+            ''')
+            
+            conn.commit()
+        finally:
+            conn.close()
     
     def save_conversation(self, user_id, user_message, ai_response):
         """
         Save a conversation to the database
+        Returns the user's new conversation total once the write is committed
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        # Reject bad rows here rather than letting them fail a shared batch
+        if not isinstance(user_id, str) or not user_id:
+            raise ValueError("user_id must be a non-empty string")
+        if not isinstance(user_message, str) or not isinstance(ai_response, str):
+            raise ValueError("user_message and ai_response must be strings")
         
         timestamp = datetime.now().isoformat()
+        return self._writes.submit((user_id, user_message, ai_response, timestamp))
+    
+    def _write_batch(self, rows):
+        """
+        Insert a batch of (user_id, user_message, ai_response, timestamp)
+        rows and update user stats in a single transaction
+        Returns each row's resulting conversation total, in order
+        """
+        with self._conn_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            try:
+                # Insert conversations
+                cursor.executemany('''
+                    INSERT INTO conversations (user_id, user_message, ai_response, timestamp)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+                
+                # Update user stats, reading back each row's new total
+                totals = []
+                for row in rows:
+                    cursor.execute('''
+                        INSERT INTO user_stats (user_id, total_conversations, last_active)
+                        VALUES (?, 1, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            total_conversations = total_conversations + 1,
+                            last_active = excluded.last_active
+                        RETURNING total_conversations
+                    ''', (row[0], row[3]))
+                    totals.append(cursor.fetchone()[0])
+                
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            
+            # Refresh cached counts with the exact totals just written
+            for row, total in zip(rows, totals):
+                self._store_count(row[0], total)
         
-        # Insert conversation
-        cursor.execute('''
-            INSERT INTO conversations (user_id, user_message, ai_response, timestamp)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, user_message, ai_response, timestamp))
-        
-        # Update user stats
-        cursor.execute('''
-            INSERT INTO user_stats (user_id, total_conversations, last_active)
-            VALUES (?, 1, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                total_conversations = total_conversations + 1,
-                last_active = ?
-        ''', (user_id, timestamp, timestamp))
-        
-        conn.commit()
-        conn.close()
+        return totals
     
     def get_conversation_history(self, user_id, limit=20):
         """
         Get conversation history for a user
         Returns list of conversations in chronological order
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._conn_lock:
+            rows = self._fetch_history(self.get_connection().cursor(), user_id, limit)
         
-        cursor.execute('''
-            SELECT user_message, ai_response, timestamp
-            FROM conversations
-            WHERE user_id = ?
-            ORDER BY id DESC
-            LIMIT ?
-        ''', (user_id, limit))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        # Convert to list of dictionaries and reverse to get chronological order
-        history = [dict(row) for row in rows]
-        history.reverse()
-        
-        return history
+        # Already in chronological order, just convert to dictionaries
+        return [dict(row) for row in rows]
     
     def get_conversation_count(self, user_id):
         """
         Get total number of conversations for a user
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        count = self._get_cached_count(user_id)
+        if count is None:
+            with self._conn_lock:
+                count = self._load_count(self.get_connection().cursor(), user_id)
+        
+        return count
+    
+    def get_history_and_count(self, user_id, limit=20):
+        """
+        Get conversation history and total conversation count in one go
+        Returns (history rows, count) using a single connection and cursor
+        The count is always read from the database, since the in-process
+        cache can lag behind writes made by other worker processes
+        """
+        with self._conn_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            # Rows support lookup by column name, so skip the dict conversion
+            history = self._fetch_history(cursor, user_id, limit)
+            
+            count = self._load_count(cursor, user_id)
+        
+        return history, count
+    
+    def _fetch_history(self, cursor, user_id, limit):
+        """Fetch a user's latest `limit` conversations, oldest first"""
+        cursor.execute('''
+            SELECT user_message, ai_response, timestamp
+            FROM (
+                SELECT id, user_message, ai_response, timestamp
+                FROM conversations
+                WHERE user_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            )
+            ORDER BY id ASC
+        ''', (user_id, limit))
         
+        return cursor.fetchall()
+    
+    def _load_count(self, cursor, user_id):
+        """Read a user's conversation count from the database and cache it"""
         cursor.execute('''
             SELECT total_conversations
             FROM user_stats
@@ -131,57 +299,74 @@ class Database:
         ''', (user_id,))
         
         row = cursor.fetchone()
-        conn.close()
+        count = row['total_conversations'] if row else 0
+        self._store_count(user_id, count)
         
-        return row['total_conversations'] if row else 0
+        return count
+    
+    def _store_count(self, user_id, count):
+        """Cache a user's conversation count"""
+        with self._count_lock:
+            self._count_cache[user_id] = (count, time.monotonic() + self.COUNT_CACHE_TTL)
+            self._count_cache.move_to_end(user_id)
+            if len(self._count_cache) > self.COUNT_CACHE_SIZE:
+                self._count_cache.popitem(last=False)
+    
+    def _get_cached_count(self, user_id):
+        """Return a fresh cached count, or None if missing or expired"""
+        with self._count_lock:
+            entry = self._count_cache.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._count_cache[user_id]
+                return None
+            self._count_cache.move_to_end(user_id)
+            return entry[0]
     
     def clear_user_history(self, user_id):
         """
         Clear all conversation history for a user
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            DELETE FROM conversations
-            WHERE user_id = ?
-        ''', (user_id,))
-        
-        cursor.execute('''
-            DELETE FROM user_stats
-            WHERE user_id = ?
-        ''', (user_id,))
+        with self._conn_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                DELETE FROM conversations
+                WHERE user_id = ?
+            ''', (user_id,))
+            
+            cursor.execute('''
+                DELETE FROM user_stats
+                WHERE user_id = ?
+            ''', (user_id,))
+            
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        with self._count_lock:
+            self._count_cache.pop(user_id, None)
     
     def get_user_level(self, user_id):
         """
         Get user's current level
         """
-        count = self.get_conversation_count(user_id)
-        
-        if count > 50:
-            return "Advanced"
-        elif count > 20:
-            return "Intermediate"
-        else:
-            return "Beginner"
+        return level_for(self.get_conversation_count(user_id))
     
     def get_all_users(self):
         """
         Get list of all users (for admin purposes)
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT user_id, total_conversations, level, last_active
-            FROM user_stats
-            ORDER BY last_active DESC
-        ''')
-        
-        rows = cursor.fetchall()
-        conn.close()
+        with self._conn_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT user_id, total_conversations, level, last_active
+                FROM user_stats
+                ORDER BY last_active DESC
+            ''')
+            
+            rows = cursor.fetchall()
         
         return [dict(row) for row in rows]
@@ -0,0 +1,22 @@
+"""
+Gunicorn configuration for TEM backend
+Picked up automatically by `gunicorn app:app` when run from backend/
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# /api/chat spends almost all of its time waiting on OpenRouter, so each
+# worker serves many requests as greenlets that yield on socket waits
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 500))
+
+# Upstream calls can take up to the 30s request timeout
+timeout = 60
+
+# Import the app once in the master so the prompt, session setup and
+# schema checks are shared copy-on-write by every forked worker
+preload_app = True
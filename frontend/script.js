@@ -118,19 +118,55 @@ async function sendMessage() {
   showLoading(true);
 
   try {
-    const res = await fetch(`${API_BASE_URL}/api/chat`, {
+    const res = await fetch(`${API_BASE_URL}/api/chat/stream`, {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify({ message: text, user_id: USER_ID }),
     });
+    if (!res.ok || !res.body) throw new Error(`HTTP ${res.status}`);
+
+    // Reply arrives as server-sent events: {delta}, then {done} or {error}
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let reply = "";
+    let contentEl = null;
+    let finished = false;
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split("\n\n");
+      buffer = events.pop();
+
+      for (const event of events) {
+        if (!event.startsWith("data: ")) continue;
+        const data = JSON.parse(event.slice(6));
+        if (data.error) throw new Error(data.message);
+
+        if (data.delta) {
+          if (!contentEl) {
+            contentEl = addMessage("ai", "");
+            showLoading(false);
+          }
+          reply += data.delta;
+          contentEl.innerHTML = escapeHtml(reply);
+          if (autoScrollEnabled) chatContainer.scrollTop = chatContainer.scrollHeight;
+        }
+
+        if (data.done) {
+          finished = true;
+          updateUserStats(data.level, data.conversation_count);
+        }
+      }
+    }
 
-    const data = await res.json();
-    if (data.error) throw new Error(data.message);
-
-    addMessage("ai", data.response);
-    updateUserStats(data.level, data.conversation_count);
+    // A stream that ends without "done" was cut off or failed server-side
+    if (!finished) throw new Error("Stream ended early");
 
-    if (voiceResponseEnabled) speak(data.response);
+    if (voiceResponseEnabled && reply) speak(reply);
 
   } catch {
     addMessage("ai", "Sorry, something went wrong.");
@@ -156,6 +192,8 @@ function addMessage(sender, text) {
 
   chatContainer.appendChild(div);
   if (autoScrollEnabled) chatContainer.scrollTop = chatContainer.scrollHeight;
+
+  return div.querySelector(".message-content");
 }
 
 function escapeHtml(text) {